@@ -1,18 +1,146 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, make_response
+from flask_session import Session
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from jinja2 import FileSystemBytecodeCache
+from whitenoise import WhiteNoise
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import timedelta
 import sqlite3
+import queue
+import threading
+from collections import Counter
+import redis
+import json
 import os
 
 app = Flask(__name__)
 app.secret_key = 'demo_secret_key'
 
+# Serve static files from WSGI middleware so they never reach Flask's views
+if os.path.isdir(app.static_folder):
+    app.wsgi_app = WhiteNoise(app.wsgi_app, root=app.static_folder, prefix='static/')
+
+# Redis connection shared by sessions and caching
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+USER_CACHE_KEY = 'user:v3:{username}'
+USER_CACHE_TTL = 300
+LEADERBOARD_KEY = 'leaderboard'
+LEADERBOARD_TTL = 300
+GAME_RESULTS = ('win', 'loss', 'tie')
+MAX_RESULTS_PER_REQUEST = 20
+redis_client = redis.Redis.from_url(REDIS_URL, socket_keepalive=True)
+
+# Leaderboard scores only ever rise. The scripts compare before writing rather
+# than using ZADD GT, which needs Redis 6.2+, so any server with Lua works.
+
+# Raise a user's score only if the set exists, so a win never creates a partial set
+update_leaderboard_score = redis_client.register_script('''
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return 0
+    end
+    local current = redis.call('ZSCORE', KEYS[1], ARGV[2])
+    if not current or tonumber(current) < tonumber(ARGV[1]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+    end
+    return 1
+''')
+
+# Load (score, member) pairs, keeping any higher score from a concurrent win, then set the TTL
+rebuild_leaderboard = redis_client.register_script('''
+    for i = 2, #ARGV, 2 do
+        local current = redis.call('ZSCORE', KEYS[1], ARGV[i + 1])
+        if not current or tonumber(current) < tonumber(ARGV[i]) then
+            redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    return 1
+''')
+
+# Server-side sessions: the cookie only carries a signed session id
+app.config['SESSION_TYPE'] = 'redis'
+app.config['SESSION_REDIS'] = redis_client
+app.config['SESSION_USE_SIGNER'] = True
+app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)
+Session(app)
+
+# Behind a reverse proxy, set TRUSTED_PROXIES to the number of proxy hops so
+# rate limits see the client's address instead of the proxy's
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Cap password-hashing endpoints per client, tracked in the same Redis
+limiter = Limiter(get_remote_address, app=app, storage_uri=REDIS_URL)
+
+# Keep compiled templates on disk so restarted workers skip parsing
+# (without JINJA_CACHE_DIR, Jinja uses its own private per-user directory)
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR')
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
 # Database setup
 DATABASE = 'users.db'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 4))
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def _open_connection():
+    """Open a long-lived connection tuned for concurrent request handling"""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA cache_size=-20000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA foreign_keys=ON;
+    ''')
+    return conn
+
+def get_pool():
+    """Create the connection pool on first use"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            pool = queue.Queue(maxsize=DB_POOL_SIZE)
+            for _ in range(DB_POOL_SIZE):
+                pool.put(_open_connection())
+            _db_pool = pool
+    return _db_pool
+
+@app.before_request
+def acquire_db():
+    """Check out a pooled connection for the duration of the request"""
+    g.db_pool = get_pool()
+    g.db = g.db_pool.get()
+
+@app.teardown_request
+def release_db(exc):
+    """Return the request's connection to the pool"""
+    conn = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    if conn is not None:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
 def init_db():
     """Initialize the database with users, notes, and game stats tables"""
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
+
+    # WAL mode is persisted in the database file, so every later connection uses it
+    cursor.execute('PRAGMA journal_mode=WAL')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -33,6 +161,9 @@ def init_db():
         )
     ''')
 
+    # Created separately from the table so older databases also get it
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_notes_user ON notes (user_id)')
+
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS game_stats (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -45,31 +176,83 @@ def init_db():
         )
     ''')
 
-    # Create a demo user (username: demo, password: demo123)
-    demo_password_hash = generate_password_hash('demo123')
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (username, email, password_hash) 
-        VALUES (?, ?, ?)
-    ''', ('demo', 'demo@example.com', demo_password_hash))
+    # Seed users (demo: username demo, password demo123)
+    seeds = [
+        ('demo', 'demo@example.com', 'demo123'),
+    ]
+
+    # Only hash passwords for seed users that don't exist yet
+    placeholders = ', '.join('?' for _ in seeds)
+    cursor.execute(f'SELECT username FROM users WHERE username IN ({placeholders})',
+                   [username for username, _, _ in seeds])
+    existing = {row[0] for row in cursor.fetchall()}
+    new_users = [
+        (username, email, generate_password_hash(password, method='scrypt'))
+        for username, email, password in seeds
+        if username not in existing
+    ]
+
+    with conn:
+        cursor.executemany('''
+            INSERT OR IGNORE INTO users (username, email, password_hash) 
+            VALUES (?, ?, ?)
+        ''', new_users)
 
-    conn.commit()
     conn.close()
 
 def get_user(username):
-    """Get user from database"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+    """Get user from cache, falling back to the database"""
+    key = USER_CACHE_KEY.format(username=username)
+    cached = redis_client.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
+    cursor = g.db.cursor()
+    cursor.execute('SELECT id, username, password_hash FROM users WHERE username = ?', (username,))
     user = cursor.fetchone()
-    conn.close()
+    if user:
+        redis_client.setex(key, USER_CACHE_TTL, json.dumps(dict(user)))
     return user
 
+def get_leaderboard(limit=5):
+    """Get the top winners from the Redis sorted set, rebuilding it from the database if missing
+
+    The set expires after LEADERBOARD_TTL seconds, so a score overwritten by a
+    rebuild that raced with a win is corrected on the next rebuild.
+    """
+    # Check for the set and read it in a single round trip
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.exists(LEADERBOARD_KEY)
+    pipe.zrevrange(LEADERBOARD_KEY, 0, limit - 1, withscores=True)
+    exists, top = pipe.execute()
+
+    if not exists:
+        cursor = g.db.cursor()
+        cursor.execute('''
+            SELECT u.username, g.wins 
+            FROM users u 
+            JOIN game_stats g ON u.id = g.user_id 
+            WHERE g.wins > 0
+        ''')
+        rows = cursor.fetchall()
+        if rows:
+            args = [LEADERBOARD_TTL]
+            for row in rows:
+                args.extend((row['wins'], row['username']))
+            rebuild_leaderboard(keys=[LEADERBOARD_KEY], args=args)
+            top = redis_client.zrevrange(LEADERBOARD_KEY, 0, limit - 1, withscores=True)
+
+    return [(username.decode(), int(wins)) for username, wins in top]
+
 @app.route('/')
 def landing():
     """Landing page"""
-    return render_template('landing.html')
+    resp = make_response(render_template('landing.html'))
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('5/minute', methods=['POST'])
 def login():
     """Login page and handler"""
     if request.method == 'POST':
@@ -78,9 +261,9 @@ def login():
 
         user = get_user(username)
 
-        if user and check_password_hash(user[3], password):  # user[3] is password_hash
-            session['user_id'] = user[0]
-            session['username'] = user[1]
+        if user and check_password_hash(user['password_hash'], password):
+            session['user_id'] = user['id']
+            session['username'] = user['username']
             flash('Login successful!', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -89,6 +272,7 @@ def login():
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('5/minute', methods=['POST'])
 def register():
     """Registration page and handler"""
     if request.method == 'POST':
@@ -96,28 +280,26 @@ def register():
         email = request.form['email']
         password = request.form['password']
 
-        # Check if user already exists
-        if get_user(username):
-            flash('Username already exists', 'error')
-            return render_template('register.html')
-
-        # Create new user
+        # Create new user; duplicates are rejected by the UNIQUE constraints
         password_hash = generate_password_hash(password)
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
+        conn = g.db
 
         try:
-            cursor.execute('''
-                INSERT INTO users (username, email, password_hash) 
-                VALUES (?, ?, ?)
-            ''', (username, email, password_hash))
-            conn.commit()
+            with conn:
+                conn.execute('''
+                    INSERT INTO users (username, email, password_hash) 
+                    VALUES (?, ?, ?)
+                ''', (username, email, password_hash))
+            redis_client.delete(USER_CACHE_KEY.format(username=username))
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
-        except sqlite3.IntegrityError:
-            flash('Username or email already exists', 'error')
-        finally:
-            conn.close()
+        except sqlite3.IntegrityError as e:
+            if 'users.username' in str(e):
+                flash('Username already exists', 'error')
+            elif 'users.email' in str(e):
+                flash('Email already exists', 'error')
+            else:
+                flash('Username or email already exists', 'error')
 
     return render_template('register.html')
 
@@ -128,7 +310,11 @@ def dashboard():
         flash('Please login to access the dashboard', 'error')
         return redirect(url_for('login'))
 
-    return render_template('dashboard.html', username=session['username'])
+    # The ETag hashes the rendered page, which includes the username
+    resp = make_response(render_template('dashboard.html', username=session['username']))
+    resp.cache_control.private = True
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 @app.route('/notepad', methods=['GET', 'POST'])
 def notepad():
@@ -138,49 +324,38 @@ def notepad():
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    conn = sqlite3.connect(DATABASE)
+    conn = g.db
     cursor = conn.cursor()
 
     if request.method == 'POST':
         # Save notes
         notes_content = request.form['notes']
 
-        # Check if user already has notes
-        cursor.execute('SELECT id FROM notes WHERE user_id = ?', (user_id,))
-        existing_note = cursor.fetchone()
-
-        if existing_note:
-            # Update existing notes
-            cursor.execute('''
-                UPDATE notes SET content = ?, last_updated = CURRENT_TIMESTAMP 
-                WHERE user_id = ?
-            ''', (notes_content, user_id))
-        else:
-            # Create new notes entry
-            cursor.execute('''
+        # Create the notes entry or overwrite the existing one
+        with conn:
+            conn.execute('''
                 INSERT INTO notes (user_id, content) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    content = excluded.content,
+                    last_updated = CURRENT_TIMESTAMP
             ''', (user_id, notes_content))
 
-        conn.commit()
         flash('Notes saved successfully!', 'success')
 
-    # Fetch user's notes
-    cursor.execute('SELECT content, last_updated FROM notes WHERE user_id = ?', (user_id,))
+    # Fetch user's notes, formatting the timestamp as e.g. '2024-01-02 at 03:04 PM'
+    cursor.execute('''
+        SELECT content,
+               strftime('%Y-%m-%d at ', last_updated)
+               || printf('%02d', (CAST(strftime('%H', last_updated) AS INTEGER) + 11) % 12 + 1)
+               || strftime(':%M ', last_updated)
+               || CASE WHEN CAST(strftime('%H', last_updated) AS INTEGER) < 12 THEN 'AM' ELSE 'PM' END
+               AS last_saved
+        FROM notes WHERE user_id = ?
+    ''', (user_id,))
     note_data = cursor.fetchone()
 
-    notes = note_data[0] if note_data else ''
-    last_saved = note_data[1] if note_data else None
-
-    # Format last_saved timestamp
-    if last_saved:
-        from datetime import datetime
-        try:
-            dt = datetime.fromisoformat(last_saved.replace('Z', '+00:00'))
-            last_saved = dt.strftime('%Y-%m-%d at %I:%M %p')
-        except:
-            last_saved = last_saved
-
-    conn.close()
+    notes = note_data['content'] if note_data else ''
+    last_saved = note_data['last_saved'] if note_data else None
 
     return render_template('notepad.html',
                          username=session['username'],
@@ -195,18 +370,7 @@ def tictactoe():
         return redirect(url_for('login'))
 
     # Get leaderboard data
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT u.username, g.wins 
-        FROM users u 
-        JOIN game_stats g ON u.id = g.user_id 
-        WHERE g.wins > 0
-        ORDER BY g.wins DESC 
-        LIMIT 5
-    ''')
-    leaderboard = cursor.fetchall()
-    conn.close()
+    leaderboard = get_leaderboard()
 
     return render_template('tictactoe.html', username=session['username'], leaderboard=leaderboard)
 
@@ -217,39 +381,38 @@ def update_game_stats():
         return jsonify({'status': 'error'}), 401
 
     user_id = session['user_id']
-    result = request.json.get('result')  # 'win', 'loss', or 'tie'
-
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-
-    # Check if user has stats record
-    cursor.execute('SELECT wins, losses, ties FROM game_stats WHERE user_id = ?', (user_id,))
-    stats = cursor.fetchone()
-
-    if stats:
-        wins, losses, ties = stats
-        if result == 'win':
-            wins += 1
-        elif result == 'loss':
-            losses += 1
-        elif result == 'tie':
-            ties += 1
-
-        cursor.execute('''
-            UPDATE game_stats SET wins = ?, losses = ?, ties = ? WHERE user_id = ?
-        ''', (wins, losses, ties, user_id))
-    else:
-        # Create new stats record
-        wins = 1 if result == 'win' else 0
-        losses = 1 if result == 'loss' else 0
-        ties = 1 if result == 'tie' else 0
-
-        cursor.execute('''
+    # Either a list of results or a single one: 'win', 'loss', or 'tie'
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error'}), 400
+    results = data.get('results')
+    if results is None:
+        results = [data.get('result')]
+    if (not isinstance(results, list) or len(results) > MAX_RESULTS_PER_REQUEST
+            or not all(isinstance(r, str) and r in GAME_RESULTS for r in results)):
+        return jsonify({'status': 'error'}), 400
+
+    conn = g.db
+
+    # Increment the counters by the batch totals, creating the stats record if needed
+    counts = Counter(results)
+    wins = counts['win']
+    losses = counts['loss']
+    ties = counts['tie']
+
+    with conn:
+        total_wins = conn.execute('''
             INSERT INTO game_stats (user_id, wins, losses, ties) VALUES (?, ?, ?, ?)
-        ''', (user_id, wins, losses, ties))
-
-    conn.commit()
-    conn.close()
+            ON CONFLICT(user_id) DO UPDATE SET
+                wins = wins + excluded.wins,
+                losses = losses + excluded.losses,
+                ties = ties + excluded.ties
+            RETURNING wins
+        ''', (user_id, wins, losses, ties)).fetchone()['wins']
+
+    # Only update an existing leaderboard; a missing one is rebuilt from the database
+    if wins:
+        update_leaderboard_score(keys=[LEADERBOARD_KEY], args=[total_wins, session['username']])
 
     return jsonify({'status': 'success'})
 
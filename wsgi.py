@@ -0,0 +1,11 @@
+"""Production entry point
+
+Run with: gunicorn -k gevent -w 4 --worker-connections 1000 wsgi:app
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from app import app, init_db
+
+# Initialize database on startup
+init_db()